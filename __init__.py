@@ -34,7 +34,8 @@ _NODE_CLASSES: List[Type] = [DreamSineWave, DreamLinear, DreamCSVCurve, DreamBea
                              DreamTriangleEvent, DreamSmoothEvent, DreamCalculation, DreamImageColorShift,
                              DreamComparePalette, DreamImageContrast, DreamImageBrightness, DreamLogFile,
                              DreamLaboratory, DreamStringToLog, DreamIntToLog, DreamFloatToLog, DreamJoinLog,
-                             DreamStringTokenizer, DreamWavCurve, DreamFrameCounterTimeOffset, DreamRandomPromptWords]
+                             DreamStringTokenizer, DreamWavCurve, DreamFrameCounterTimeOffset, DreamRandomPromptWords,
+                             DreamImageBatchToSequence, DreamImageSequenceWindowLoader, DreamVideoFrameLoader]
 _SIGNATURE_SUFFIX = " [Dream]"
 
 MANIFEST = {
@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-import glob
-
 from .categories import NodeCategories
 from .shared import *
 from .dreamtypes import *
@@ -42,7 +40,7 @@ class DreamDirectoryFileCount:
         return {
             "required": {
                 "directory_path": ("STRING", {"default": '', "multiline": False}),
-                "patterns": ("STRING", {"default": '*.jpg|*.png|*.jpeg', "multiline": False}),
+                "patterns": ("STRING", {"default": '*.jpg|*.png|*.jpeg|*.webp', "multiline": False}),
             },
         }
 
@@ -53,22 +51,14 @@ class DreamDirectoryFileCount:
 
     @classmethod
     def IS_CHANGED(cls, directory_path, patterns):
-        if not os.path.isdir(directory_path):
+        if not directory_path or not os.path.isdir(directory_path):
             return ""
-        total = 0
-        for pattern in patterns.split("|"):
-            files = list(glob.glob(pattern, root_dir=directory_path))
-            total += len(files)
-        return total
+        return directory_index(directory_path).count(patterns)
 
     def result(self, directory_path, patterns):
-        if not os.path.isdir(directory_path):
+        if not directory_path or not os.path.isdir(directory_path):
             return (0,)
-        total = 0
-        for pattern in patterns.split("|"):
-            files = list(glob.glob(pattern, root_dir=directory_path))
-            total += len(files)
-        return (total,)
+        return (directory_index(directory_path).count(patterns),)
 
 
 class DreamFrameCounterOffset:
@@ -161,20 +151,16 @@ class DreamDirectoryBackedFrameCounter:
     FUNCTION = "result"
 
     @classmethod
-    def IS_CHANGED(cls, directory_path, patterns, indexing, total_frames, frames_per_second):
-        if not os.path.isdir(directory_path):
+    def IS_CHANGED(cls, directory_path, pattern, indexing, total_frames, frames_per_second):
+        if not directory_path or not os.path.isdir(directory_path):
             return ""
-        total = 0
-        for pattern in patterns.split("|"):
-            files = list(glob.glob(pattern, root_dir=directory_path))
-            total += len(files)
-        return (total, indexing, total_frames, frames_per_second)
+        n = directory_index(directory_path).max_index(pattern, indexing == "alphabetic order") + 1
+        return (n, indexing, total_frames, frames_per_second)
 
     def result(self, directory_path, pattern, indexing, total_frames, frames_per_second):
-        results = list_images_in_directory(directory_path, pattern, indexing == "alphabetic order")
-        if not results:
+        if not directory_path or not os.path.isdir(directory_path):
             return (FrameCounter(0, total_frames, frames_per_second),)
-        n = max(results.keys()) + 1
+        n = directory_index(directory_path).max_index(pattern, indexing == "alphabetic order") + 1
         return (FrameCounter(n, total_frames, frames_per_second),)
 
 
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Times loading of the WAV Curve data for synthetic 1, 10 and 60 minute WAV files and checks the bucket values
+# against the original per-sample implementation.
+#
+#   python benchmarks/wav_curve.py [--minutes 1 10 60] [--fps 25] [--skip-reference]
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy
+from scipy.io.wavfile import write as wav_write
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_curves():
+    # the node modules are imported without running the package __init__ (which needs a ComfyUI installation)
+    package = types.ModuleType("dream_project")
+    package.__path__ = [PACKAGE_ROOT]
+    sys.modules["dream_project"] = package
+    return importlib.import_module("dream_project.curves")
+
+
+def _reference_buckets(sampling_rate, single_channel_samples, fps):
+    length_in_seconds = len(single_channel_samples) / sampling_rate
+    num_buckets = round(length_in_seconds * fps * 3)
+    bucket_size = len(single_channel_samples) / float(num_buckets)
+    buckets = list()
+    max_bucket_value = 0
+    for i in range(num_buckets):
+        start_index = round(i * bucket_size)
+        end_index = round((i + 1) * bucket_size) - 1
+        samples = list(map(lambda n: abs(n), single_channel_samples[start_index:end_index]))
+        bucket_total = sum(samples)
+        buckets.append(bucket_total)
+        max_bucket_value = max(bucket_total, max_bucket_value)
+    return [float(b) / max_bucket_value for b in buckets]
+
+
+def _synthetic_wav(path, minutes, sampling_rate=48000):
+    rng = numpy.random.default_rng(int(minutes * 60))
+    n = int(minutes * 60 * sampling_rate)
+    t = numpy.arange(n, dtype=numpy.float64) / sampling_rate
+    envelope = 0.5 + 0.5 * numpy.sin(2 * numpy.pi * 0.5 * t)
+    signal = envelope * numpy.sin(2 * numpy.pi * 440.0 * t) + 0.1 * rng.standard_normal(n)
+    samples = numpy.clip(signal * 20000, -32768, 32767).astype(numpy.int16)
+    wav_write(path, sampling_rate, numpy.stack([samples, samples[::-1]], axis=1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", type=float, nargs="+", default=[1, 10, 60])
+    parser.add_argument("--fps", type=float, default=25.0)
+    parser.add_argument("--skip-reference", action="store_true")
+    args = parser.parse_args()
+
+    curves = _load_curves()
+    with tempfile.TemporaryDirectory() as tmp:
+        for minutes in args.minutes:
+            path = os.path.join(tmp, "synthetic_{}.wav".format(minutes))
+            _synthetic_wav(path, minutes)
+            curves._wav_loader.cache_clear()
+            tracemalloc.start()
+            started = time.perf_counter()
+            data = curves._wav_loader(path, args.fps)
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            line = "{:>5} min: {:8.3f} s, peak {:7.1f} MB".format(minutes, elapsed, peak / (1024 * 1024))
+            if not args.skip_reference:
+                sampling_rate, samples = curves.wav_read(path)
+                started = time.perf_counter()
+                reference = _reference_buckets(sampling_rate, samples[:, 0], args.fps)
+                reference_elapsed = time.perf_counter() - started
+                identical = list(map(float, data._buckets)) == reference
+                line += ", reference {:8.3f} s, identical: {}".format(reference_elapsed, identical)
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import functools
 import math
 import os
 
+import numpy
 from scipy.io.wavfile import read as wav_read
 
 from .categories import NodeCategories
@@ -111,37 +112,119 @@ class DreamTriangleWave:
         return _curve_result(y)
 
 
+# samples read from the wav file at a time when building the buckets
+_WAV_CHUNK_SAMPLES = 1 << 20
+
+
 class WavData:
     def __init__(self, sampling_rate: float, single_channel_samples, fps: float):
         self._length_in_seconds = len(single_channel_samples) / sampling_rate
         self._num_buckets = round(self._length_in_seconds * fps * 3)
         self._bucket_size = len(single_channel_samples) / float(self._num_buckets)
-        self._buckets = list()
         self._rate = sampling_rate
-        self._max_bucket_value = 0
-        for i in range(self._num_buckets):
-            start_index = round(i * self._bucket_size)
-            end_index = round((i + 1) * self._bucket_size) - 1
-            samples = list(map(lambda n: abs(n), single_channel_samples[start_index:end_index]))
-            bucket_total = sum(samples)
-            self._buckets.append(bucket_total)
-            self._max_bucket_value=max(bucket_total, self._max_bucket_value)
-
-        for i in range(self._num_buckets):
-            self._buckets[i] = float(self._buckets[i]) / self._max_bucket_value
+        self._buckets = self._bucket_totals(single_channel_samples)
+        self._max_bucket_value = self._buckets.max()
+        if self._max_bucket_value > 0:
+            self._buckets = self._buckets / float(self._max_bucket_value)
+
+    def _bucket_totals(self, samples):
+        # sum of abs(sample) over samples[start:end - 1] for each bucket, accumulated as 64 bit values in sample
+        # order - the last sample of each bucket is not included. The samples are read in chunks of whole buckets,
+        # so that a memory mapped file is never read into memory at once.
+        positions = numpy.arange(self._num_buckets, dtype=numpy.float64)
+        starts = numpy.rint(positions * self._bucket_size).astype(numpy.int64)
+        ends = numpy.rint((positions + 1) * self._bucket_size).astype(numpy.int64) - 1
+        dtype = numpy.float64 if numpy.issubdtype(samples.dtype, numpy.floating) else numpy.int64
+        totals = numpy.zeros(self._num_buckets, dtype=dtype)
+        num_samples = len(samples)
+        chunk_buckets = max(1, int(_WAV_CHUNK_SAMPLES / max(1.0, self._bucket_size)))
+        for first in range(0, self._num_buckets, chunk_buckets):
+            last = min(self._num_buckets, first + chunk_buckets)
+            begin = min(int(starts[first]), num_samples - 1)
+            # one sample beyond the last bucket end, so that the end bound is a valid index
+            stop = min(num_samples, int(ends[last - 1]) + 1)
+            if stop <= begin:
+                continue
+            chunk = numpy.abs(samples[begin:stop])
+            bounds = numpy.empty((last - first) * 2, dtype=numpy.int64)
+            bounds[0::2] = starts[first:last] - begin
+            bounds[1::2] = ends[first:last] - begin
+            bounds = numpy.clip(bounds, 0, len(chunk) - 1)
+            totals[first:last] = numpy.add.reduceat(chunk, bounds, dtype=dtype)[0::2]
+        # reduceat gives the first sample for empty ranges
+        totals[ends <= starts] = 0
+        return totals
 
     def value_at_time(self, second: float) -> float:
         if second < 0.0 or second > self._length_in_seconds:
             return 0.0
         nsample = second * self._rate
         nbucket = min(max(0, round(nsample / self._bucket_size)), self._num_buckets - 1)
-        return self._buckets[nbucket]
+        return float(self._buckets[nbucket])
+
+
+class _Int24Samples:
+    # one channel of 24 bit pcm data in a memory mapped file, decoded as int32 like scipy does (in the upper 3 bytes)
+    dtype = numpy.dtype(numpy.int32)
+
+    def __init__(self, data, channel):
+        self._data = data
+        self._channel = channel
+
+    def __len__(self):
+        return self._data.shape[0]
+
+    def __getitem__(self, item):
+        raw = self._data[item, self._channel, :].astype(numpy.int32)
+        return (raw[..., 0] << 8) | (raw[..., 1] << 16) | (raw[..., 2] << 24)
+
+
+def _wav_header(filepath):
+    # (channels, sampling rate, bits per sample, data offset, data size), None if the file could not be parsed
+    with open(filepath, "rb") as f:
+        header = f.read(12)
+        if header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+            return None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            (chunk_id, chunk_size) = (chunk[0:4], int.from_bytes(chunk[4:8], "little"))
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                if len(fmt) < 16:
+                    return None
+                f.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data" and fmt is not None:
+                return (int.from_bytes(fmt[2:4], "little"), int.from_bytes(fmt[4:8], "little"),
+                        int.from_bytes(fmt[14:16], "little"), f.tell(), chunk_size)
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def _map_int24_wav(filepath, header):
+    (channels, rate, _, offset, size) = header
+    frames = min(size, os.path.getsize(filepath) - offset) // (3 * channels)
+    data = numpy.memmap(filepath, dtype=numpy.uint8, mode="r", offset=offset, shape=(frames, channels, 3))
+    return (rate, _Int24Samples(data, 0))
+
+
+def _wav_channel(filepath):
+    # the first channel, memory mapped - scipy cannot map 24 bit files
+    try:
+        (sampling_rate, samples) = wav_read(filepath, mmap=True)
+    except ValueError:
+        header = _wav_header(filepath)
+        if header is None or header[2] != 24 or not header[0]:
+            raise
+        return _map_int24_wav(filepath, header)
+    return (sampling_rate, samples[:, 0] if samples.ndim > 1 else samples)
 
 
 @functools.lru_cache(4)
 def _wav_loader(filepath, fps):
-    sampling_rate, samples = wav_read(filepath)
-    single_channel = samples[:, 0]
+    sampling_rate, single_channel = _wav_channel(filepath)
     return WavData(sampling_rate, single_channel, fps)
 
 
@@ -205,11 +205,15 @@ class FrameCounter:
 class AnimationSequence:
     ID = "ANIMATION_SEQUENCE"
 
-    def __init__(self, frame_counter: FrameCounter, frames: Dict[int, List[str]] = None):
+    def __init__(self, frame_counter: FrameCounter, frames: Dict[int, List[str]] = None, stores: List = None):
         self.frames = frames
+        self.stores = stores
         self.fps = frame_counter.frames_per_second
         self.frame_counter = frame_counter
-        if self.is_defined:
+        if self.is_stored:
+            self.keys_in_order = list(range(min(map(len, self.stores))))
+            self.num_batches = len(self.stores)
+        elif self.is_defined:
             self.keys_in_order = sorted(frames.keys())
             self.num_batches = min(map(len, self.frames.values()))
         else:
@@ -224,9 +228,16 @@ class AnimationSequence:
         for key in self.keys_in_order:
             yield self.frames[key][batch_num]
 
+    @property
+    def is_stored(self):
+        if self.stores:
+            return True
+        else:
+            return False
+
     @property
     def is_defined(self):
-        if self.frames:
+        if self.frames or self.stores:
             return True
         else:
             return False
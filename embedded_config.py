@@ -4,7 +4,20 @@ EMBEDDED_CONFIGURATION = {
         "path": "ffmpeg",
         "arguments": ["-r", "%FPS%", "-f", "concat", "-safe", "0", "-vsync",
                       "cfr", "-i", "%FRAMES%", "-c:v", "libx264", "-pix_fmt",
-                      "yuv420p", "%OUTPUT%"]
+                      "yuv420p", "%OUTPUT%"],
+        "mode": "concat",
+        "pipe_arguments": ["-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "%WIDTH%x%HEIGHT%", "-r", "%FPS%",
+                           "-i", "-", "-c:v", "libx264", "-pix_fmt", "yuv420p", "%OUTPUT%"],
+        "pipe_queue": 8,
+        "incremental": False,
+        "incremental_arguments": ["-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "%WIDTH%x%HEIGHT%", "-r", "%FPS%",
+                                  "-i", "-", "-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags",
+                                  "+frag_keyframe+empty_moov+default_base_moof", "%OUTPUT%"],
+        "segments": 1,
+        "workers": 1,
+        "concat_arguments": ["-f", "concat", "-safe", "0", "-i", "%SEGMENTS%", "-c", "copy", "%OUTPUT%"],
+        "progress": True,
+        "progress_interval": 5.0
     },
     "mpeg_coder": {
         "encoding_threads": 4,
@@ -13,8 +26,42 @@ EMBEDDED_CONFIGURATION = {
         "file_extension": "mp4",
         "codec_name": "libx264"
     },
+    "imageio": {
+        "codec": "libx264",
+        "quality": 8,
+        "pixelformat": "yuv420p",
+        "macro_block_size": 2,
+        "output_params": [],
+        "incremental_output_params": ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+    },
     "encoding": {
-        "jpeg_quality": 95
+        "jpeg_quality": 95,
+        "video_backend": "ffmpeg",
+        "write_behind_workers": 4,
+        "write_behind_queue": 8,
+        "formats": {
+            "png": {"optimize": True, "compress_level": 6},
+            "png_fast": {"optimize": False, "compress_level": 1},
+            "webp_lossless": {"lossless": True, "quality": 50, "method": 2}
+        }
+    },
+    "sequence": {
+        "prefetch_frames": 8,
+        "encode_workers": 4,
+        "encode_queue": 16,
+        "parallel_batches": 1,
+        "checkpoints": True,
+        "png_format": "png_fast"
+    },
+    "video_source": {
+        "ffprobe_path": "",
+        "decode_arguments": ["-v", "error", "-ss", "%START%", "-i", "%INPUT%", "-map", "0:v:0", "-vsync",
+                             "passthrough", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+    },
+    "loader": {
+        "cache_bytes": 536870912,
+        "read_ahead_frames": 1,
+        "feedback_in_memory": True
     },
     "debug": False,
     "ui": {
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import json
+import mmap
+import os
+import random
+import threading
+
+import numpy
+
+RAW_FRAMES_NAME = "seq_frames"
+
+
+def _write_json_atomic(filepath, data):
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, filepath)
+
+
+class RawFrameBatch:
+    in_memory = False
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._raw_path = os.path.join(directory, RAW_FRAMES_NAME + ".raw")
+        self._index_path = os.path.join(directory, RAW_FRAMES_NAME + ".json")
+        with open(self._index_path, encoding="utf-8") as f:
+            index = json.load(f)
+        self.ext = index.get("format", ".png")
+        self._shape = tuple(index["shape"])
+        self._length = int(index["frames"])
+        self._mmap = None
+        self._frames = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def files(self):
+        return [self._raw_path, self._index_path]
+
+    def _data(self):
+        with self._lock:
+            if self._frames is None:
+                with open(self._raw_path, "rb") as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                count = self._length * int(numpy.prod(self._shape))
+                self._frames = numpy.frombuffer(self._mmap, dtype=numpy.uint8, count=count).reshape(
+                    (self._length,) + self._shape)
+            return self._frames
+
+    def frame(self, index) -> numpy.ndarray:
+        # copied out of the mapping, so that the store can be closed and removed while frames are still in use
+        return numpy.array(self._data()[index])
+
+    def close(self):
+        with self._lock:
+            if self._frames is not None:
+                self._frames = None
+                self._mmap.close()
+                self._mmap = None
+
+    def remove(self):
+        self.close()
+        for path in (self._raw_path, self._index_path):
+            if os.path.isfile(path):
+                os.unlink(path)
+
+
+class FrameRange:
+    # a contiguous range of the frames of a store that are read one at a time, so that slicing and iterating does
+    # not load the whole store into memory
+    def __init__(self, store, start: int, stop: int):
+        self.store = store
+        self._start = start
+        self._stop = max(start, stop)
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            (start, stop, step) = item.indices(len(self))
+            if step != 1:
+                raise Exception("Frame ranges can only be sliced contiguously")
+            return FrameRange(self.store, self._start + start, self._start + stop)
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError(item)
+        return self.store.frame(self._start + item)
+
+    def __iter__(self):
+        for index in range(self._start, self._stop):
+            yield self.store.frame(index)
+
+
+class RawFrameBatchWriter:
+    def __init__(self, directory: str, ext: str):
+        self.directory = directory
+        self._ext = ext
+        self._tmp_path = os.path.join(directory, "tmp_" + RAW_FRAMES_NAME + "_" + str(random.randint(0, 1000000))
+                                      + ".raw")
+        self._file = open(self._tmp_path, "wb")
+        self._shape = None
+        self._length = 0
+
+    def write(self, index: int, frame: numpy.ndarray):
+        frame = numpy.ascontiguousarray(frame, dtype=numpy.uint8)
+        if self._shape is None:
+            self._shape = frame.shape
+        elif frame.shape != self._shape:
+            raise Exception("Frame shape {} differs from stored frames {}".format(frame.shape, self._shape))
+        self._file.seek(index * frame.nbytes)
+        self._file.write(frame.data)
+        self._length = max(self._length, index + 1)
+
+    def finalize(self) -> RawFrameBatch:
+        self._file.close()
+        os.replace(self._tmp_path, os.path.join(self.directory, RAW_FRAMES_NAME + ".raw"))
+        _write_json_atomic(os.path.join(self.directory, RAW_FRAMES_NAME + ".json"),
+                           {"frames": self._length, "shape": list(self._shape), "format": self._ext})
+        return RawFrameBatch(self.directory)
+
+    def remove(self):
+        if not self._file.closed:
+            self._file.close()
+        if os.path.isfile(self._tmp_path):
+            os.unlink(self._tmp_path)
+
+
+class TensorFrameBatch:
+    in_memory = True
+
+    def __init__(self, frames: numpy.ndarray, directory: str, ext: str = ".png"):
+        self.directory = directory
+        self.ext = ext
+        self._frames = frames
+
+    def __len__(self):
+        return self._frames.shape[0]
+
+    def frame(self, index) -> numpy.ndarray:
+        return self._frames[index]
+
+    def close(self):
+        pass
+
+    def remove(self):
+        # the frames are only referenced from memory - they go away with the sequence
+        pass
@@ -1,9 +1,126 @@
 # -*- coding: utf-8 -*-
+import atexit
+import fnmatch
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List
+
+import numpy
+import torch
+
 from .categories import NodeCategories
-from .shared import list_images_in_directory, DreamImage
+from .shared import list_images_in_directory, DreamImage, DreamConfig, hashed_as_strings, get_feedback_frame
 from .dreamtypes import SharedTypes, FrameCounter
+from .video_decoding import VideoFrameReader
 import os
 
+CONFIG = DreamConfig()
+
+
+def _tensor_bytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+
+class _DecodedFrameCache:
+    # decoded image tensors by file path, size and modification time - least recently used are dropped first
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frames = OrderedDict()
+        self._bytes = 0
+        self._loading: Dict[tuple, Future] = {}
+        self._executor = None
+
+    @staticmethod
+    def _key(file_path, target_size):
+        stat = os.stat(file_path)
+        return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, target_size)
+
+    def _put(self, key, tensor):
+        limit = int(CONFIG.get("loader.cache_bytes", 512 * 1024 * 1024))
+        size = _tensor_bytes(tensor)
+        if size > limit:
+            return
+        with self._lock:
+            if key in self._frames:
+                return
+            self._frames[key] = tensor
+            self._bytes += size
+            while self._bytes > limit:
+                (_, dropped) = self._frames.popitem(last=False)
+                self._bytes -= _tensor_bytes(dropped)
+
+    def _load(self, key, file_path, target_size):
+        try:
+            if target_size > 0:
+                image = DreamImage.from_file(file_path, (target_size, target_size))
+            else:
+                image = DreamImage(file_path=file_path)
+            tensor = image.create_tensor_image()
+            self._put(key, tensor)
+            return tensor
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def get(self, file_path, target_size: int = 0) -> torch.Tensor:
+        key = self._key(file_path, target_size)
+        with self._lock:
+            tensor = self._frames.get(key, None)
+            if tensor is not None:
+                self._frames.move_to_end(key)
+                return tensor
+            future = self._loading.get(key, None)
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                # decoded again below, failing in the calling node
+                pass
+        return self._load(key, file_path, target_size)
+
+    def read_ahead(self, file_paths: List[str], target_size: int = 0):
+        for file_path in file_paths:
+            try:
+                key = self._key(file_path, target_size)
+            except OSError:
+                continue
+            with self._lock:
+                if key in self._frames or key in self._loading:
+                    continue
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dream_read_ahead")
+                self._loading[key] = self._executor.submit(self._load, key, file_path, target_size)
+
+
+_decoded_frames = _DecodedFrameCache()
+
+
+def _feedback_frame(frame: int, directory_path, pattern, indexing):
+    # the frame just saved to the directory by the sequence saver, without waiting for the file to be written
+    if indexing != "numeric" or not directory_path or not CONFIG.get("loader.feedback_in_memory", True):
+        return None
+    feedback = get_feedback_frame(directory_path, frame)
+    if feedback is None:
+        return None
+    for (file_path, _) in feedback[1]:
+        file_name = os.path.basename(file_path)
+        if not fnmatch.fnmatch(file_name, pattern) or (file_name.startswith(".") and not pattern.startswith(".")):
+            return None
+    return feedback
+
+
+def _file_fingerprint(file_paths: List[str]):
+    # a new or rewritten file changes size or modification time
+    fingerprint = list()
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+            fingerprint.append((file_path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            fingerprint.append((file_path, None))
+    return fingerprint
+
 
 class DreamImageSequenceInputWithDefaultFallback:
     NODE_NAME = "Image Sequence Loader"
@@ -18,7 +135,8 @@ class DreamImageSequenceInputWithDefaultFallback:
                 "indexing": (["numeric", "alphabetic order"],)
             },
             "optional": {
-                "default_image": ("IMAGE", {"default": None})
+                "default_image": ("IMAGE", {"default": None}),
+                "decode_size": ("INT", {"default": 0, "min": 0, "max": 16384}),
             }
         }
 
@@ -28,16 +146,161 @@ class DreamImageSequenceInputWithDefaultFallback:
     FUNCTION = "result"
 
     @classmethod
-    def IS_CHANGED(cls, *values, **kwargs):
-        return float("NaN")
+    def IS_CHANGED(cls, frame_counter: FrameCounter, directory_path, pattern, indexing, **other):
+        feedback = _feedback_frame(frame_counter.current_frame, directory_path, pattern, indexing)
+        if feedback is not None:
+            return hashed_as_strings(frame_counter.current_frame, "feedback", feedback[0])
+        entries = list_images_in_directory(directory_path, pattern, indexing == "alphabetic order")
+        return hashed_as_strings(frame_counter.current_frame,
+                                 *_file_fingerprint(entries.get(frame_counter.current_frame, [])))
 
     def result(self, frame_counter: FrameCounter, directory_path, pattern, indexing, **other):
         default_image = other.get("default_image", None)
+        decode_size = other.get("decode_size", 0)
+        feedback = _feedback_frame(frame_counter.current_frame, directory_path, pattern, indexing)
+        if feedback is not None and not decode_size:
+            files = feedback[1]
+            images = torch.cat([tensor for (_, tensor) in files], dim=0) if len(files) > 1 else files[0][1]
+            return (images, os.path.basename(files[0][0]))
         entries = list_images_in_directory(directory_path, pattern, indexing == "alphabetic order")
         entry = entries.get(frame_counter.current_frame, None)
         if not entry:
             return (default_image, "")
         else:
             image_names = [os.path.basename(file_path) for file_path in entry]
-            images = map(lambda f: DreamImage(file_path=f), entry)
-            return (DreamImage.join_to_tensor_data(images), image_names[0]) 
+            images = torch.cat([_decoded_frames.get(f, decode_size) for f in entry], dim=0)
+            # the next frames are decoded in the background, while the current one is being used
+            for n in range(1, int(CONFIG.get("loader.read_ahead_frames", 1)) + 1):
+                _decoded_frames.read_ahead(entries.get(frame_counter.current_frame + n, []), decode_size)
+            return (images, image_names[0])
+
+
+class DreamImageSequenceWindowLoader:
+    NODE_NAME = "Image Sequence Window Loader"
+    ICON = "💾"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": SharedTypes.frame_counter | {
+                "directory_path": ("STRING", {"default": '', "multiline": False}),
+                "pattern": ("STRING", {"default": '*', "multiline": False}),
+                "indexing": (["numeric", "alphabetic order"],),
+                "frames_before": ("INT", {"default": 1, "min": 0, "max": 100}),
+                "frames_after": ("INT", {"default": 1, "min": 0, "max": 100}),
+            },
+            "optional": {
+                "default_image": ("IMAGE", {"default": None}),
+                "decode_size": ("INT", {"default": 0, "min": 0, "max": 16384}),
+            }
+        }
+
+    CATEGORY = NodeCategories.IMAGE_ANIMATION
+    RETURN_TYPES = ("IMAGE", "INT")
+    RETURN_NAMES = ("images", "frames_found")
+    FUNCTION = "result"
+
+    @classmethod
+    def _window(cls, entries, frame, frames_before, frames_after):
+        # frame index for each position of the window - missing frames are replaced by the closest one found
+        found = [i for i in range(frame - frames_before, frame + frames_after + 1) if entries.get(i, None)]
+        if not found:
+            return ([], 0)
+        return ([min(found, key=lambda f: (abs(f - i), f)) for i in range(frame - frames_before,
+                                                                          frame + frames_after + 1)], len(found))
+
+    @classmethod
+    def IS_CHANGED(cls, frame_counter: FrameCounter, directory_path, pattern, indexing, frames_before, frames_after,
+                   **other):
+        entries = list_images_in_directory(directory_path, pattern, indexing == "alphabetic order")
+        (window, _) = cls._window(entries, frame_counter.current_frame, frames_before, frames_after)
+        return hashed_as_strings(frame_counter.current_frame, *window,
+                                 *_file_fingerprint([f for i in sorted(set(window)) for f in entries[i]]))
+
+    def result(self, frame_counter: FrameCounter, directory_path, pattern, indexing, frames_before, frames_after,
+               **other):
+        default_image = other.get("default_image", None)
+        decode_size = other.get("decode_size", 0)
+        entries = list_images_in_directory(directory_path, pattern, indexing == "alphabetic order")
+        (window, found) = self._window(entries, frame_counter.current_frame, frames_before, frames_after)
+        if not window:
+            return (default_image, 0)
+        # frames in the window are decoded once and shared with the next windows through the decode cache
+        images = list()
+        for frame in window:
+            feedback = None if decode_size else _feedback_frame(frame, directory_path, pattern, indexing)
+            if feedback is not None:
+                images.extend([tensor for (_, tensor) in feedback[1]])
+            else:
+                images.extend([_decoded_frames.get(f, decode_size) for f in entries[frame]])
+        _decoded_frames.read_ahead(entries.get(frame_counter.current_frame + frames_after + 1, []), decode_size)
+        return (torch.cat(images, dim=0), found)
+
+
+_video_readers: Dict[tuple, VideoFrameReader] = {}
+_video_readers_lock = threading.Lock()
+
+
+@atexit.register
+def _close_video_readers():
+    for reader in list(_video_readers.values()):
+        reader.close()
+    _video_readers.clear()
+
+
+def _video_reader(video_path) -> VideoFrameReader:
+    # one reader per video file, replaced when the file is modified
+    stat = os.stat(video_path)
+    key = (os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns)
+    with _video_readers_lock:
+        reader = _video_readers.get(key, None)
+        if reader is None:
+            for old_key in [k for k in _video_readers.keys() if k[0] == key[0]]:
+                _video_readers.pop(old_key).close()
+            reader = VideoFrameReader(video_path, CONFIG)
+            _video_readers[key] = reader
+        return reader
+
+
+class DreamVideoFrameLoader:
+    NODE_NAME = "Video Frame Loader"
+    ICON = "🎞"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": SharedTypes.frame_counter | {
+                "video_path": ("STRING", {"default": '', "multiline": False}),
+                "indexing": (["frame number", "time"],),
+            },
+            "optional": {
+                "default_image": ("IMAGE", {"default": None})
+            }
+        }
+
+    CATEGORY = NodeCategories.IMAGE_ANIMATION
+    RETURN_TYPES = ("IMAGE", "INT", "FLOAT")
+    RETURN_NAMES = ("image", "total_frames", "frames_per_second")
+    FUNCTION = "result"
+
+    @classmethod
+    def IS_CHANGED(cls, frame_counter: FrameCounter, video_path, indexing, **other):
+        if not os.path.isfile(video_path):
+            return ""
+        stat = os.stat(video_path)
+        return hashed_as_strings(os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns, indexing,
+                                 frame_counter.current_frame, frame_counter.frames_per_second)
+
+    def result(self, frame_counter: FrameCounter, video_path, indexing, **other):
+        default_image = other.get("default_image", None)
+        if not os.path.isfile(video_path):
+            return (default_image, 0, 0.0)
+        reader = _video_reader(video_path)
+        if indexing == "time":
+            frame = reader.index.frame_at_time(frame_counter.current_time_in_seconds)
+        else:
+            frame = frame_counter.current_frame
+        if frame >= len(reader.index):
+            return (default_image, len(reader.index), reader.index.fps)
+        image = torch.from_numpy(reader.frame(frame).astype(numpy.float32) / 255.0).unsqueeze(0)
+        return (image, len(reader.index), reader.index.fps)
@@ -1,17 +1,90 @@
 # -*- coding: utf-8 -*-
+import atexit
 import json
 import os
 
 import folder_paths as comfy_paths
+import numpy
 from PIL.PngImagePlugin import PngInfo
 
 from .categories import NodeCategories
 from .shared import DreamImageProcessor, DreamImage, \
-    list_images_in_directory, DreamConfig
+    list_images_in_directory, DreamConfig, write_behind, flush_pending_writes, invalidate_directory_index, \
+    store_feedback_frame
 from .dreamtypes import SharedTypes, FrameCounter, AnimationSequence, LogEntry
+from .framestore import TensorFrameBatch
+from .video_encoding import create_video_writer, find_free_filename
 
 CONFIG = DreamConfig()
 
+_incremental_writers = dict()
+
+# entries of encoding.formats used by the file types of the sequence saver
+_FILETYPE_FORMATS = {
+    "png with embedded workflow": "png",
+    "png": "png",
+    "jpg": "jpg",
+    "png (fast)": "png_fast",
+    "webp (lossless)": "webp_lossless"
+}
+
+
+@atexit.register
+def _close_incremental_writers():
+    for writer in list(_incremental_writers.values()):
+        try:
+            writer.close()
+        except Exception:
+            pass
+    _incremental_writers.clear()
+
+
+class _SavedFrameManifest:
+    # the frames written by the saver to a directory, one json line per file, so that the sequence can be built
+    # without scanning the directory
+    NAME = "dream_saved_frames.jsonl"
+
+    def __init__(self, directory_path):
+        self._directory = os.path.abspath(directory_path)
+        self._filepath = os.path.join(self._directory, _SavedFrameManifest.NAME)
+
+    def reset(self):
+        if os.path.isfile(self._filepath):
+            os.unlink(self._filepath)
+
+    def append(self, frame, batch_counter, filepath):
+        os.makedirs(self._directory, exist_ok=True)
+        entry = {"frame": frame, "batch": batch_counter, "file": os.path.relpath(filepath, self._directory)}
+        with open(self._filepath, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def frames(self, ext, last_frame):
+        # None if there is no manifest or it does not cover all frames up to last_frame
+        if not os.path.isfile(self._filepath):
+            return None
+        files = dict()
+        with open(self._filepath, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if os.path.splitext(entry["file"])[1].lower() == ext:
+                    files[(entry["frame"], entry["batch"])] = os.path.join(self._directory, entry["file"])
+        result = dict()
+        for ((frame, _), filepath) in sorted(files.items()):
+            result.setdefault(frame, []).append(filepath)
+        if sorted(result.keys()) != list(range(last_frame + 1)):
+            return None
+        if not all(map(os.path.isfile, result[last_frame])):
+            return None
+        return result
+
+
+def _write_frame(dream_image: DreamImage, filepath, format_name, embed_info, prompt, extra_pnginfo):
+    dream_image.save_with_format(filepath, format_name, embed_info, prompt, extra_pnginfo)
+    invalidate_directory_index(os.path.dirname(filepath))
+
 
 def _save_png(pil_image, filepath, embed_info, prompt, extra_pnginfo):
     info = PngInfo()
@@ -43,7 +116,7 @@ class DreamImageSequenceOutput:
                 "prefix": ("STRING", {"default": 'frame', "multiline": False}),
                 "digits": ("INT", {"default": 5}),
                 "at_end": (["stop output", "raise error", "keep going"],),
-                "filetype": (['png with embedded workflow', "png", 'jpg'],),
+                "filetype": (['png with embedded workflow', "png", 'jpg', 'png (fast)', 'webp (lossless)'],),
             },
             "hidden": {
                 "prompt": "PROMPT",
@@ -78,19 +151,56 @@ class DreamImageSequenceOutput:
         save_dir = os.path.dirname(filepath)
         if not os.path.isdir(save_dir):
             os.makedirs(save_dir)
-        if filetype.startswith("png"):
-            dream_image.save_png(filepath, filetype == 'png with embedded workflow', prompt, extra_pnginfo)
-        elif filetype == "jpg":
-            dream_image.save_jpg(filepath, int(CONFIG.get("encoding.jpeg_quality", 95)))
+        write_behind(_write_frame, dream_image, filepath, _FILETYPE_FORMATS[filetype],
+                     filetype == 'png with embedded workflow', prompt, extra_pnginfo)
+        manifest = _SavedFrameManifest(directory_path)
+        if frame_counter.is_first_frame and batch_counter <= 0:
+            manifest.reset()
+        manifest.append(frame_counter.current_frame, batch_counter, filepath)
+        if CONFIG.get("loader.feedback_in_memory", True) and _FILETYPE_FORMATS[filetype] != "jpg":
+            # lossless formats only, so that the loader gets the same image from memory as from the file
+            self._feedback.append((filepath, dream_image.create_tensor_image()))
         logger("Saved {} in {}".format(filename, os.path.abspath(save_dir)))
+        if CONFIG.get("ffmpeg.incremental", False):
+            self._encode_incremental(dream_image, batch_counter, frame_counter, save_dir, prefix, logger)
         return ()
 
+    def _encode_incremental(self, dream_image: DreamImage, batch_counter, frame_counter: FrameCounter, save_dir,
+                            prefix, logger):
+        key = (os.path.abspath(save_dir), batch_counter)
+        writer = _incremental_writers.get(key, None)
+        if writer is not None and frame_counter.is_first_frame:
+            # a new animation is started in the same directory
+            del _incremental_writers[key]
+            writer.close()
+            writer = None
+        if writer is None:
+            filename = prefix + "." + CONFIG.get("ffmpeg.file_extension", "mp4").strip(".")
+            writer = create_video_writer(CONFIG, find_free_filename(filename, key[0]),
+                                         frame_counter.frames_per_second, frame_counter.total_frames,
+                                         incremental=True)
+            _incremental_writers[key] = writer
+        try:
+            writer.write(numpy.asarray(dream_image.pil_image.convert("RGB")))
+        except Exception:
+            _incremental_writers.pop(key, None)
+            # ends the ffmpeg process, which would otherwise keep waiting for frames
+            try:
+                writer.close()
+            except Exception:
+                pass
+            raise
+        if frame_counter.is_final_frame:
+            del _incremental_writers[key]
+            writer.close()
+            logger("Generated video '{}' ({})".format(writer.output, writer.progress.summary()))
+
     def _generate_animation_sequence(self, filetype, directory_path, frame_counter):
-        if filetype.startswith("png"):
-            pattern = "*.png"
-        else:
-            pattern = "*.jpg"
-        frames = list_images_in_directory(directory_path, pattern, False)
+        ext = "." + filetype.split(" ")[0]
+        frames = _SavedFrameManifest(directory_path).frames(ext, frame_counter.current_frame)
+        if frames is None:
+            # frames saved before the manifest was started, or by another node
+            frames = list_images_in_directory(directory_path, "*" + ext, False)
         return AnimationSequence(frame_counter, frames)
 
     def save(self, image, **args):
@@ -99,14 +209,46 @@ class DreamImageSequenceOutput:
         if not args.get("directory_path", ""):
             args["directory_path"] = comfy_paths.output_directory
         args["logger"] = logger
+        self._feedback = list()
         proc = DreamImageProcessor(image, **args)
         proc.process(self._save_single_image)
         frame_counter = args["frame_counter"]
+        if self._feedback:
+            store_feedback_frame(args["directory_path"], frame_counter.current_frame, self._feedback)
         log_entry = LogEntry([])
         for text in log_texts:
             log_entry = log_entry.add(text)
         if frame_counter.is_final_frame:
+            flush_pending_writes()
             return (self._generate_animation_sequence(args["filetype"], args["directory_path"],
                                                       frame_counter), log_entry)
         else:
             return (AnimationSequence(frame_counter), log_entry)
+
+
+class DreamImageBatchToSequence:
+    NODE_NAME = "Image Batch to Sequence"
+    ICON = "🎞"
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "image": ("IMAGE",),
+                "frames_per_second": ("INT", {"min": 1, "default": 25}),
+                "directory_path": ("STRING", {"default": comfy_paths.output_directory, "multiline": False}),
+            },
+        }
+
+    CATEGORY = NodeCategories.IMAGE_ANIMATION
+    RETURN_TYPES = (AnimationSequence.ID,)
+    RETURN_NAMES = ("sequence",)
+    FUNCTION = "convert"
+
+    def convert(self, image, frames_per_second, directory_path):
+        if not directory_path:
+            directory_path = comfy_paths.output_directory
+        frames = numpy.clip(255. * image.cpu().numpy(), 0, 255).astype(numpy.uint8)
+        n = frames.shape[0]
+        counter = FrameCounter(n - 1, n, frames_per_second)
+        return (AnimationSequence(counter, stores=[TensorFrameBatch(frames, directory_path)]),)
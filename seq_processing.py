@@ -1,24 +1,98 @@
 # -*- coding: utf-8 -*-
 import os
 import shutil
-import subprocess
 import tempfile
-from functools import lru_cache
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 
+import numpy
 from PIL import Image as PilImage
 
 from .categories import NodeCategories
 from .err import on_error
-from .shared import DreamConfig
+from .shared import DreamConfig, DreamWorkerPool, get_logger, hashed_as_strings
+from .framestore import FrameRange, RawFrameBatchWriter, TensorFrameBatch
+from .video_encoding import FFmpegProgress, create_video_writer, decoded_frames, ffmpeg_command, \
+    find_free_filename, run_ffmpeg
 #from .shared import MpegEncoderUtility
 from .dreamtypes import *
 
 CONFIG = DreamConfig()
 
-
-@lru_cache(5)
-def _load_image_cached(filename):
-    return PilImage.open(filename)
+_FRAME_STORAGE_OPTIONS = ["image files", "raw frame store"]
+
+
+def _decode_frame(filename) -> DreamImage:
+    pil_image = PilImage.open(filename)
+    pil_image.load()
+    return DreamImage(pil_image=pil_image)
+
+
+class _FramePrefetcher:
+    def __init__(self, load, length: int, index_offsets: List[int], read_ahead: int):
+        self._load = load
+        self._length = length
+        self._min_offset = min(index_offsets)
+        self._max_offset = max(index_offsets)
+        self._read_ahead = max(0, read_ahead)
+        self._frames: Dict[int, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dream_prefetch")
+
+    def _clamp(self, index):
+        return min(max(0, index), self._length - 1)
+
+    def advance(self, cursor: int):
+        first = self._clamp(cursor + self._min_offset)
+        last = self._clamp(cursor + self._max_offset + self._read_ahead)
+        for index in list(self._frames.keys()):
+            if index < first:
+                self._frames.pop(index).cancel()
+        for index in range(first, last + 1):
+            if index not in self._frames:
+                self._frames[index] = self._executor.submit(self._load, index)
+
+    def get(self, index) -> DreamImage:
+        return self._frames[self._clamp(index)].result()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._frames = {}
+
+
+def _tween_frames(current_frame: DreamImage, next_frame: DreamImage, multiplier: int):
+    # all intermediate frames at once as a [multiplier, H, W, C] uint8 array, frame i having weight
+    # (i + 1) / multiplier of next_frame - rounding as in PIL Image.blend
+    a = current_frame.numpy_array().astype(numpy.float32)
+    b = next_frame.numpy_array().astype(numpy.float32)
+    alphas = (numpy.arange(multiplier, dtype=numpy.float32) + 1.0) / multiplier
+    alphas = alphas.reshape((multiplier,) + (1,) * a.ndim)
+    return (a + alphas * (b - a)).astype(numpy.uint8)
+
+
+def _save_frame(img, filepath, ext):
+    if isinstance(img, numpy.ndarray):
+        img = DreamImage(pil_image=PilImage.fromarray(img))
+    if ext == ".png":
+        img.save_with_format(filepath, CONFIG.get("sequence.png_format", "png_fast"))
+    elif ext == ".webp":
+        img.save_with_format(filepath, "webp_lossless")
+    else:
+        img.save_with_format(filepath, "jpg")
+
+
+def _iterated_kernel_weights(index: int, last_index: int, taps: Dict[int, float], iterations: int) -> Dict[int, float]:
+    # weights of the input frames contributing to output frame 'index' after repeatedly applying the
+    # kernel 'taps' (offset -> weight), with frame indices clamped to the sequence like the processor does
+    weights = {index: 1.0}
+    for _ in range(iterations):
+        spread = dict()
+        for (i, w) in weights.items():
+            for (offset, tap) in taps.items():
+                j = min(max(0, i + offset), last_index)
+                spread[j] = spread.get(j, 0.0) + w * tap
+        weights = spread
+    return weights
 
 
 class TempFileSet:
@@ -30,7 +104,8 @@ class TempFileSet:
 
     def remove(self):
         for f in self._files.keys():
-            os.unlink(f)
+            if os.path.isfile(f):
+                os.unlink(f)
 
     def finalize(self):
         for a, b in self._files.items():
@@ -38,67 +113,355 @@ class TempFileSet:
         self._files = dict()
 
 
+class _Checkpoint:
+    # append-only record of the input frames whose output frames have all been saved, one line per input frame
+    def __init__(self, filepath, fingerprint):
+        self._filepath = filepath
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self.completed: Dict[int, List[int]] = dict()
+        self.finalizing = False
+        self.stale = False
+        if os.path.isfile(filepath):
+            self._read(fingerprint)
+        if not os.path.isfile(filepath):
+            with open(filepath, "w", encoding="utf-8") as f:
+                f.write("inputs " + fingerprint + "\n")
+
+    def _read(self, fingerprint):
+        with open(self._filepath, encoding="utf-8") as f:
+            lines = f.readlines()
+        for line in lines:
+            if not line.endswith("\n"):
+                # interrupted while writing
+                break
+            tokens = line.split()
+            if tokens[:1] == ["inputs"]:
+                self.stale = tokens[1:] != [fingerprint]
+            elif tokens == ["finalize"]:
+                self.finalizing = True
+            elif len(tokens) > 1:
+                self.completed[int(tokens[0])] = list(map(int, tokens[1:]))
+        if self.stale and not self.finalizing:
+            os.unlink(self._filepath)
+
+    def _append(self, line):
+        with self._lock:
+            with open(self._filepath, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def expect(self, index, result_indices: List[int]):
+        with self._lock:
+            self._pending[index] = [len(result_indices), result_indices]
+
+    def saved(self, index):
+        with self._lock:
+            pending = self._pending[index]
+            pending[0] -= 1
+            if pending[0] > 0:
+                return
+            del self._pending[index]
+        self._append(" ".join(map(str, [index] + sorted(pending[1]))))
+
+    def mark_finalizing(self):
+        self._append("finalize")
+
+    def remove(self):
+        if os.path.isfile(self._filepath):
+            os.unlink(self._filepath)
+
+
+_CHECKPOINT_DIR_PREFIX = ".dream_checkpoint_"
+
+
+def _remove_orphaned_checkpoints(output_dir, keep_dir):
+    # checkpoints of other jobs, e.g. left by a failed run with other parameters, can not be resumed any more
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        if name.startswith(_CHECKPOINT_DIR_PREFIX) and path != keep_dir and os.path.isdir(path):
+            get_logger().info("Removing checkpoint '{}' of an earlier job", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class _FileOutput:
+    def __init__(self, output_dir, ext, job_key=None, fingerprint=""):
+        self._output_dir = output_dir
+        self._ext = ext
+        self._workset = TempFileSet()
+        self._checkpoint = None
+        if job_key:
+            # checkpointed frames are kept in a hidden directory, so that they are never listed as frames
+            self._tmp_dir = os.path.join(output_dir, _CHECKPOINT_DIR_PREFIX + job_key)
+            self._tmp_prefix = ""
+            _remove_orphaned_checkpoints(output_dir, self._tmp_dir)
+            os.makedirs(self._tmp_dir, exist_ok=True)
+            self._checkpoint = _Checkpoint(os.path.join(self._tmp_dir, "checkpoint"), fingerprint)
+        else:
+            self._tmp_dir = output_dir
+            self._tmp_prefix = "tmp_" + str(random.randint(0, 1000000)) + "_"
+        self._encoder = DreamWorkerPool(int(CONFIG.get("sequence.encode_workers", 4)),
+                                        int(CONFIG.get("sequence.encode_queue", 16)), "dream_encode")
+        self._files = dict()
+        self._finalized = False
+
+    def _paths(self, result_index):
+        return (os.path.join(self._tmp_dir, self._tmp_prefix + (str(result_index).zfill(8)) + self._ext),
+                os.path.join(self._output_dir, "seq_" + (str(result_index).zfill(8)) + self._ext))
+
+    @property
+    def finalizing(self):
+        return self._checkpoint is not None and self._checkpoint.finalizing
+
+    @property
+    def final_paths(self):
+        return set(map(os.path.abspath, self._files.values()))
+
+    def resume(self):
+        # input indices completed by an earlier, interrupted run
+        if self._checkpoint is None:
+            return set()
+        completed = self._checkpoint.completed
+        if self._checkpoint.stale and not self._checkpoint.finalizing:
+            for name in os.listdir(self._tmp_dir):
+                filepath = os.path.join(self._tmp_dir, name)
+                if name != "checkpoint" and os.path.isfile(filepath):
+                    os.unlink(filepath)
+            return set()
+        resumed = set()
+        for (index, result_indices) in completed.items():
+            paths = list(map(self._paths, result_indices))
+            if not self.finalizing and not all(os.path.isfile(filepath) for (filepath, _) in paths):
+                continue
+            for (result_index, (filepath, filepath_final)) in zip(result_indices, paths):
+                # when finalizing, some files may already have been moved to their final name
+                if os.path.isfile(filepath):
+                    self._workset.add(filepath, filepath_final)
+                self._files[result_index] = filepath_final
+            resumed.add(index)
+        if resumed:
+            get_logger().info("Resuming '{}' with {} of the input frames already processed", self._output_dir,
+                              len(resumed))
+        return resumed
+
+    def _save(self, index, img, filepath):
+        _save_frame(img, filepath, self._ext)
+        if self._checkpoint is not None:
+            self._checkpoint.saved(index)
+
+    def add(self, index, results: Dict[int, object]):
+        # stop at the first failed save instead of processing the rest of the batch
+        self._encoder.raise_errors()
+        if self._checkpoint is not None:
+            self._checkpoint.expect(index, list(results.keys()))
+        for (result_index, img) in results.items():
+            (filepath, filepath_final) = self._paths(result_index)
+            self._encoder.submit(self._save, index, img, filepath)
+            self._workset.add(filepath, filepath_final)
+            self._files[result_index] = filepath_final
+
+    def complete(self):
+        self._encoder.wait()
+        if self._checkpoint is not None:
+            # the input frames are removed next - from here on a rerun only has to complete the renaming
+            self._checkpoint.mark_finalizing()
+
+    def finalize(self) -> List[str]:
+        self._workset.finalize()
+        self._finalized = True
+        if self._checkpoint is not None:
+            self._checkpoint.remove()
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        return [self._files[result_index] for result_index in sorted(self._files.keys())]
+
+    def close(self):
+        if self._checkpoint is not None and not self._finalized:
+            # frames already handed to the encoder are saved, they are kept for the rerun
+            try:
+                self._encoder.wait()
+            except Exception:
+                pass
+        self._encoder.shutdown()
+        if self._checkpoint is None or self._finalized:
+            self._workset.remove()
+        else:
+            get_logger().info("Keeping processed frames in '{}' for a rerun", self._output_dir)
+
+
+class _RawStoreOutput:
+    finalizing = False
+
+    def __init__(self, output_dir, ext):
+        self._writer = RawFrameBatchWriter(output_dir, ext)
+
+    def resume(self):
+        return set()
+
+    def add(self, index, results: Dict[int, object]):
+        for (result_index, img) in results.items():
+            self._writer.write(result_index, img if isinstance(img, numpy.ndarray) else img.numpy_array())
+
+    def complete(self):
+        pass
+
+    def finalize(self):
+        return self._writer.finalize()
+
+    def close(self):
+        self._writer.remove()
+
+
+class _MemoryOutput:
+    finalizing = False
+
+    def __init__(self, directory, ext):
+        self._directory = directory
+        self._ext = ext
+        self._frames = dict()
+
+    def resume(self):
+        return set()
+
+    def add(self, index, results: Dict[int, object]):
+        for (result_index, img) in results.items():
+            self._frames[result_index] = img if isinstance(img, numpy.ndarray) else img.numpy_array()
+
+    def complete(self):
+        pass
+
+    def finalize(self):
+        frames = [self._frames[index] for index in sorted(self._frames.keys())]
+        return TensorFrameBatch(numpy.stack(frames), self._directory, self._ext)
+
+    def close(self):
+        self._frames = dict()
+
+
 class AnimationSeqProcessor:
-    def __init__(self, sequence: AnimationSequence):
+    def __init__(self, sequence: AnimationSequence, to_store: bool = False):
         self._sequence = sequence
+        self._to_store = to_store
         self._input_cache = {}
         self._inputs = {}
         self._output_dirs = {}
         for b in self._sequence.batches:
-            self._inputs[b] = list(self._sequence.get_image_files_of_batch(b))
-            self._output_dirs[b] = os.path.dirname(os.path.abspath(self._inputs[b][0]))
-        self._ext = os.path.splitext(self._inputs[0][0])[1].lower()
+            if self._sequence.is_stored:
+                self._inputs[b] = self._sequence.stores[b]
+                self._output_dirs[b] = self._inputs[b].directory
+            else:
+                self._inputs[b] = list(self._sequence.get_image_files_of_batch(b))
+                self._output_dirs[b] = os.path.dirname(os.path.abspath(self._inputs[b][0]))
+        if self._sequence.is_stored:
+            self._ext = self._inputs[0].ext
+        else:
+            self._ext = os.path.splitext(self._inputs[0][0])[1].lower()
         self._length = len(self._inputs[0])
-
-    def _load_input(self, batch_id, index) -> DreamImage:
-        files = self._inputs[batch_id]
-        index = min(max(0, index), len(files) - 1)
-        filename = files[index]
-        return DreamImage(pil_image=_load_image_cached(filename))
-
-    def _process_single_batch(self, batch_id, indices, index_offsets: List[int], fun, output_dir) -> List[str]:
+        self._in_memory = self._sequence.is_stored and self._inputs[0].in_memory
+
+    def _input_loader(self, batch_id):
+        inputs = self._inputs[batch_id]
+        if self._sequence.is_stored:
+            return lambda index: DreamImage(pil_image=PilImage.fromarray(inputs.frame(index)))
+        else:
+            return lambda index: _decode_frame(inputs[index])
+
+    def _remove_inputs(self, batch_id, keep=()):
+        if self._sequence.is_stored:
+            self._inputs[batch_id].remove()
+        else:
+            for oldfile in self._inputs[batch_id]:
+                if os.path.isfile(oldfile) and os.path.abspath(oldfile) not in keep:
+                    os.unlink(oldfile)
+
+    def _checkpoint_key(self, batch_id, job_name):
+        # the same job on the same input frames gets the same key, so that a rerun finds the earlier work
+        inputs = self._inputs[batch_id]
+        if self._sequence.is_stored:
+            names = [inputs.directory, len(inputs)]
+            files = inputs.files
+        else:
+            names = files = inputs
+        stats = list(map(lambda f: (os.stat(f).st_size, os.stat(f).st_mtime_ns) if os.path.isfile(f) else None, files))
+        fingerprint = hashed_as_strings(*stats)
+        return (hashed_as_strings(job_name, self._ext, *names)[:16], fingerprint)
+
+    def _create_output(self, batch_id, output_dir, job_name):
+        if self._in_memory:
+            return _MemoryOutput(output_dir, self._ext)
+        if self._to_store:
+            return _RawStoreOutput(output_dir, self._ext)
+        if job_name and CONFIG.get("sequence.checkpoints", True):
+            (job_key, fingerprint) = self._checkpoint_key(batch_id, job_name)
+            return _FileOutput(output_dir, self._ext, job_key, fingerprint)
+        return _FileOutput(output_dir, self._ext)
+
+    def _process_single_batch(self, batch_id, indices, index_offsets: List[int], fun, output_dir, job_name=None):
         all_indices = list(indices)
         last_index = max(all_indices)
-        workset = TempFileSet()
-        rnd = random.randint(0, 1000000)
-        result_files = list()
+        output = self._create_output(batch_id, output_dir, job_name)
+        if output.finalizing:
+            # an earlier run was interrupted after all frames were processed
+            try:
+                output.resume()
+                # inputs named like the outputs may already have been replaced by finalized output frames
+                self._remove_inputs(batch_id, output.final_paths)
+                return output.finalize()
+            finally:
+                output.close()
+        prefetcher = _FramePrefetcher(self._input_loader(batch_id), len(self._inputs[batch_id]), index_offsets,
+                                      int(CONFIG.get("sequence.prefetch_frames", 8)))
         try:
+            resumed = output.resume()
             for index in all_indices:
-                images = list(map(lambda offset: self._load_input(batch_id, index + offset), index_offsets))
+                if index in resumed:
+                    continue
+                prefetcher.advance(index)
+                images = list(map(lambda offset: prefetcher.get(index + offset), index_offsets))
 
                 result: Dict[int, DreamImage] = fun(index, last_index, images)
+                results = dict()
+                submitted = set()
                 for (result_index, img) in result.items():
-                    filepath = os.path.join(output_dir,
-                                            "tmp_" + str(rnd) + "_" + (str(result_index).zfill(8)) + self._ext)
-                    filepath_final = os.path.join(output_dir, "seq_" + (str(result_index).zfill(8)) + self._ext)
-                    if self._ext == ".png":
-                        img.save_png(filepath)
-                    else:
-                        img.save_jpg(filepath, quality=CONFIG.get("encoding.jpeg_quality", 98))
-                    workset.add(filepath, filepath_final)
-                    result_files.append(filepath_final)
+                    if isinstance(img, DreamImage) and id(img) in submitted:
+                        # the same image may not be saved concurrently by several workers
+                        img = DreamImage(pil_image=img.pil_image.copy())
+                    submitted.add(id(img))
+                    results[result_index] = img
+                output.add(index, results)
+            output.complete()
+            prefetcher.close()
             # all done with batch - remove input files
-            for oldfile in self._inputs[batch_id]:
-                os.unlink(oldfile)
-            workset.finalize()
-            return result_files
+            self._remove_inputs(batch_id)
+            return output.finalize()
         finally:
-            workset.remove()
+            output.close()
+            prefetcher.close()
+
+    def process(self, index_offsets: List[int], fun, job_name=None):
+        def _process_batch(batch_id):
+            return self._process_single_batch(batch_id, range(len(self._inputs[batch_id])),
+                                              index_offsets, fun,
+                                              self._output_dirs[batch_id], job_name)
+
+        batches = list(self._sequence.batches)
+        workers = min(len(batches), int(CONFIG.get("sequence.parallel_batches", 1)))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dream_batch") as executor:
+                batch_results = list(executor.map(_process_batch, batches))
+        else:
+            batch_results = list(map(_process_batch, batches))
+
+        new_length = len(batch_results[-1])
+        new_fps = self._sequence.frame_counter.frames_per_second * (float(new_length) / self._length)
+        counter = FrameCounter(new_length - 1, new_length, new_fps)
+        if self._in_memory or self._to_store:
+            return AnimationSequence(counter, stores=batch_results)
 
-    def process(self, index_offsets: List[int], fun):
         results = dict()
-        new_length = 0
-        for batch_id in self._sequence.batches:
-            resulting_filenames = self._process_single_batch(batch_id, range(len(self._inputs[batch_id])),
-                                                             index_offsets, fun,
-                                                             self._output_dirs[batch_id])
+        for resulting_filenames in batch_results:
             for (index, filename) in enumerate(resulting_filenames):
                 l = results.get(index, [])
                 l.append(filename)
                 results[index] = l
-            new_length = len(resulting_filenames)
-        new_fps = self._sequence.frame_counter.frames_per_second * (float(new_length) / self._length)
-        counter = FrameCounter(new_length - 1, new_length, new_fps)
         return AnimationSequence(counter, results)
 
 
@@ -116,18 +479,47 @@ def _ffmpeg(config, filenames, fps, output):
         tmp.close()
 
     try:
-        cmd = [config.get("ffmpeg.path", "ffmpeg")]
-        cmd.extend(config.get("ffmpeg.arguments"))
-        replacements = {"%FPS%": str(fps), "%FRAMES%": tempfilepath, "%OUTPUT%": output}
+        cmd = ffmpeg_command(config, "ffmpeg.arguments", {"%FPS%": str(fps), "%FRAMES%": tempfilepath,
+                                                           "%OUTPUT%": output})
+        progress = FFmpegProgress(os.path.basename(output), len(filenames),
+                                  float(config.get("ffmpeg.progress_interval", 5.0)))
+        run_ffmpeg(cmd, progress, len(filenames))
+        return progress
+    finally:
+        os.unlink(tempfilepath)
 
-        for (key, value) in replacements.items():
-            cmd = list(map(lambda s: s.replace(key, value), cmd))
 
-        subprocess.check_output(cmd, shell=True)
+def _ffmpeg_concat(config, segment_files, output, total_frames):
+    tmp = tempfile.NamedTemporaryFile(delete=False, mode="wb")
+    tempfilepath = tmp.name
+    try:
+        for filename in segment_files:
+            filename = filename.replace("\\", "/")
+            tmp.write(f"file '{filename}'\n".encode())
+    finally:
+        tmp.close()
+
+    try:
+        cmd = ffmpeg_command(config, "ffmpeg.concat_arguments", {"%SEGMENTS%": tempfilepath, "%OUTPUT%": output})
+        # stream copy reports no frames - the joined video has the frames of all segments
+        run_ffmpeg(cmd, FFmpegProgress(os.path.basename(output), total_frames), total_frames)
     finally:
         os.unlink(tempfilepath)
 
 
+def _encode_frames(config, frames, fps, output):
+    # frames are either image files or a range of the frames of a frame store
+    writer = create_video_writer(config, output, fps, len(frames))
+    if not isinstance(frames, FrameRange):
+        frames = decoded_frames(frames, int(config.get("ffmpeg.pipe_queue", 8)))
+    try:
+        for frame in frames:
+            writer.write(frame[:, :, :3] if frame.ndim == 3 else numpy.stack([frame] * 3, axis=-1))
+    finally:
+        writer.close()
+    return writer.progress
+
+
 def _make_video_filename(name, file_ext):
     (b, _) = os.path.splitext(name)
     return b + "." + file_ext.strip(".")
@@ -219,21 +611,42 @@ class DreamVideoEncoder:
     def IS_CHANGED(cls, sequence: AnimationSequence, **kwargs):
         return sequence.is_defined
 
-    def _find_free_filename(self, filename, defaultdir):
-        if os.path.basename(filename) == filename:
-            filename = os.path.join(defaultdir, filename)
-        n = 1
-        tested = filename
-        while os.path.exists(tested):
-            n += 1
-            (b, ext) = os.path.splitext(filename)
-            tested = b + "_" + str(n) + ext
-        return tested
-
-    def generate_video(self, files, fps, filename, config):
-        filename = self._find_free_filename(filename, os.path.dirname(files[0]))
-        _ffmpeg(config, files, fps, filename)
-        return filename
+    def _uses_ffmpeg_binary(self, config):
+        return config.get("encoding.video_backend", "ffmpeg") == "ffmpeg"
+
+    def _encode_segment(self, frames, fps, output, config) -> FFmpegProgress:
+        if self._uses_ffmpeg_binary(config) and config.get("ffmpeg.mode", "concat") == "concat" and \
+                not isinstance(frames, FrameRange):
+            return _ffmpeg(config, frames, fps, output)
+        else:
+            return _encode_frames(config, frames, fps, output)
+
+    def _split_segments(self, files, output, config, reserved):
+        n = max(1, min(int(config.get("ffmpeg.segments", 1)), len(files)))
+        if n == 1 or not self._uses_ffmpeg_binary(config):
+            return [(files, output)]
+        (b, ext) = os.path.splitext(output)
+        segments = list()
+        for i in range(n):
+            segment_files = files[round(i * len(files) / n):round((i + 1) * len(files) / n)]
+            segment_output = find_free_filename(b + ".part" + str(i).zfill(3) + ext, os.path.dirname(output),
+                                                reserved)
+            reserved.add(segment_output)
+            segments.append((segment_files, segment_output))
+        return segments
+
+    def _complete_video(self, output, segments, futures, config):
+        try:
+            wait(futures)
+            frames = sum(map(lambda future: future.result().frames, futures))
+            if len(segments) > 1:
+                _ffmpeg_concat(config, [segment_output for (_, segment_output) in segments], output, frames)
+            return frames
+        finally:
+            if len(segments) > 1:
+                for (_, segment_output) in segments:
+                    if os.path.isfile(segment_output):
+                        os.unlink(segment_output)
 
     def encode(self, sequence: AnimationSequence, name: str, remove_images, framerate_factor):
         if not sequence.is_defined:
@@ -241,19 +654,46 @@ class DreamVideoEncoder:
 
         config = DreamConfig()
         filename = _make_video_filename(name, config.get("ffmpeg.file_extension", "mp4"))
+        fps = sequence.fps * framerate_factor
         log_entry = LogEntry([])
-        for batch_num in sequence.batches:
-            try:
-                images = list(sequence.get_image_files_of_batch(batch_num))
-                actual_filename = self.generate_video(images, sequence.fps * framerate_factor, filename, config)
-
-                log_entry = log_entry.add("Generated video '{}'".format(actual_filename))
-                if remove_images:
-                    for imagepath in images:
-                        if os.path.isfile(imagepath):
-                            os.unlink(imagepath)
-            except Exception as e:
-                on_error(self.__class__, str(e))
+        started = time.time()
+        executor = ThreadPoolExecutor(max_workers=max(1, int(config.get("ffmpeg.workers", 1))),
+                                      thread_name_prefix="dream_video")
+        try:
+            # all batches and segments are queued up front so that they are encoded concurrently
+            videos = list()
+            reserved = set()
+            for batch_num in sequence.batches:
+                if sequence.is_stored:
+                    # frames are read from the store while encoding, one at a time
+                    images = FrameRange(sequence.stores[batch_num], 0, len(sequence.keys_in_order))
+                    directory = sequence.stores[batch_num].directory
+                else:
+                    images = list(sequence.get_image_files_of_batch(batch_num))
+                    directory = os.path.dirname(images[0])
+                output = find_free_filename(filename, directory, reserved)
+                reserved.add(output)
+                segments = self._split_segments(images, output, config, reserved)
+                futures = [executor.submit(self._encode_segment, segment_frames, fps, segment_output, config)
+                           for (segment_frames, segment_output) in segments]
+                videos.append((batch_num, images, output, segments, futures))
+
+            for (batch_num, images, output, segments, futures) in videos:
+                try:
+                    frames = self._complete_video(output, segments, futures, config)
+                    elapsed = time.time() - started
+                    log_entry = log_entry.add("Generated video '{}' ({} frames in {:.1f} s, {:.1f} fps)".format(
+                        output, frames, elapsed, frames / max(0.001, elapsed)))
+                    if remove_images and sequence.is_stored:
+                        sequence.stores[batch_num].remove()
+                    elif remove_images:
+                        for imagepath in images:
+                            if os.path.isfile(imagepath):
+                                os.unlink(imagepath)
+                except Exception as e:
+                    on_error(self.__class__, str(e))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
         return (log_entry,)
 
 
@@ -266,6 +706,9 @@ class DreamSequenceTweening:
             "required": SharedTypes.sequence | {
                 "multiplier": ("INT", {"default": 2, "min": 2, "max": 10}),
             },
+            "optional": {
+                "frame_storage": (_FRAME_STORAGE_OPTIONS,),
+            },
         }
 
     CATEGORY = NodeCategories.ANIMATION_POSTPROCESSING
@@ -278,7 +721,7 @@ class DreamSequenceTweening:
     def IS_CHANGED(cls, sequence: AnimationSequence, **kwargs):
         return sequence.is_defined
 
-    def process(self, sequence: AnimationSequence, multiplier):
+    def process(self, sequence: AnimationSequence, multiplier, frame_storage=_FRAME_STORAGE_OPTIONS[0]):
         if not sequence.is_defined:
             return (sequence,)
 
@@ -291,15 +734,13 @@ class DreamSequenceTweening:
                 return results
 
             # normal case
-            current_frame = images[0]
-            next_frame = images[1]
+            frames = _tween_frames(images[0], images[1], multiplier)
             for i in range(multiplier):
-                alpha = float(i + 1) / multiplier
-                results[multiplier * input_index + i] = current_frame.blend(next_frame, 1.0 - alpha, alpha)
+                results[multiplier * input_index + i] = frames[i]
             return results
 
-        proc = AnimationSeqProcessor(sequence)
-        return (proc.process([0, 1], _generate_extra_frames),)
+        proc = AnimationSeqProcessor(sequence, frame_storage == "raw frame store")
+        return (proc.process([0, 1], _generate_extra_frames, "tween_{}".format(multiplier)),)
 
 
 class DreamSequenceBlend:
@@ -313,6 +754,9 @@ class DreamSequenceBlend:
                 "fade_out": ("FLOAT", {"default": 0.1, "min": 0.01, "max": 0.5}),
                 "iterations": ("INT", {"default": 1, "min": 1, "max": 10}),
             },
+            "optional": {
+                "frame_storage": (_FRAME_STORAGE_OPTIONS,),
+            },
         }
 
     CATEGORY = NodeCategories.ANIMATION_POSTPROCESSING
@@ -325,19 +769,26 @@ class DreamSequenceBlend:
     def IS_CHANGED(cls, sequence: AnimationSequence, **kwargs):
         return sequence.is_defined
 
-    def process(self, sequence: AnimationSequence, fade_in, fade_out, iterations):
+    def process(self, sequence: AnimationSequence, fade_in, fade_out, iterations,
+                frame_storage=_FRAME_STORAGE_OPTIONS[0]):
         if not sequence.is_defined:
             return (sequence,)
 
-        current_sequence = sequence
-        for i in range(iterations):
-            proc = AnimationSeqProcessor(current_sequence)
-
-            def _blur(index: int, last_index: int, images: List[DreamImage]):
-                pre_frame = images[0].blend(images[1], fade_in, 1.0)
-                post_frame = images[2].blend(images[1], fade_out, 1.0)
-                return {index: pre_frame.blend(post_frame)}
-
-            current_sequence = proc.process([-1, 0, 1], _blur)
-
-        return (current_sequence,)
+        taps = {-1: fade_in / (2.0 * (1.0 + fade_in)),
+                1: fade_out / (2.0 * (1.0 + fade_out))}
+        taps[0] = 1.0 - taps[-1] - taps[1]
+        offsets = list(range(-iterations, iterations + 1))
+
+        def _blur(index: int, last_index: int, images: List[DreamImage]):
+            frames = dict()
+            for (offset, image) in zip(offsets, images):
+                frames[min(max(0, index + offset), last_index)] = image
+            result = None
+            for (frame_index, weight) in _iterated_kernel_weights(index, last_index, taps, iterations).items():
+                weighted = frames[frame_index].numpy_array().astype(numpy.float32) * weight
+                result = weighted if result is None else result + weighted
+            result = numpy.clip(numpy.rint(result), 0, 255).astype(numpy.uint8)
+            return {index: DreamImage(pil_image=PilImage.fromarray(result))}
+
+        proc = AnimationSeqProcessor(sequence, frame_storage == "raw frame store")
+        return (proc.process(offsets, _blur, "blend_{}_{}_{}".format(fade_in, fade_out, iterations)),)
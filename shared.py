@@ -5,7 +5,11 @@ import json
 import os
 import random
 import tempfile
+import threading
+import time
+import fnmatch
 import glob
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 from io import BytesIO
 
 import numpy
@@ -119,6 +123,110 @@ class DreamImageProcessor:
         return tuple(map(lambda l: torch.cat(l, dim=0), output))
 
 
+class DreamWorkerPool:
+    def __init__(self, workers: int, max_pending: int, name: str = "dream_worker"):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._pending: List[Future] = []
+        self._failures: List[BaseException] = []
+
+    def _collect_failures(self):
+        # moves the errors of completed tasks to the failures, which are kept until raised
+        for future in self._pending:
+            if future.done() and not future.cancelled() and future.exception() is not None:
+                self._failures.append(future.exception())
+        self._pending = [f for f in self._pending if not f.done()]
+
+    def submit(self, fun, *args, **kwargs) -> Future:
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fun, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._collect_failures()
+            self._pending.append(future)
+        return future
+
+    def wait(self, raise_errors=True):
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        with self._lock:
+            self._collect_failures()
+        if raise_errors:
+            self.raise_errors()
+
+    def raise_errors(self):
+        # raises the errors of the already completed tasks, without waiting for the others
+        with self._lock:
+            self._collect_failures()
+            failures = self._failures
+            self._failures = []
+        if len(failures) == 1:
+            raise failures[0]
+        if failures:
+            raise Exception("{} background tasks failed: {}".format(
+                len(failures), "; ".join(map(str, failures)))) from failures[0]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._pending = []
+
+
+_write_behind_pool = None
+_write_behind_lock = threading.Lock()
+
+
+def write_behind(fun, *args, **kwargs):
+    # runs fun in the background - errors of earlier writes are raised here or by flush_pending_writes, so that
+    # they are reported by the node writing the files
+    global _write_behind_pool
+    config = DreamConfig()
+    if int(config.get("encoding.write_behind_workers", 4)) <= 0:
+        fun(*args, **kwargs)
+        return
+    with _write_behind_lock:
+        if _write_behind_pool is None:
+            _write_behind_pool = DreamWorkerPool(int(config.get("encoding.write_behind_workers", 4)),
+                                                 int(config.get("encoding.write_behind_queue", 8)),
+                                                 "dream_write_behind")
+        pool = _write_behind_pool
+    pool.raise_errors()
+    pool.submit(fun, *args, **kwargs)
+
+
+def flush_pending_writes(raise_errors=True):
+    pool = _write_behind_pool
+    if pool is not None:
+        pool.wait(raise_errors)
+
+
+_feedback_frames: Dict[str, Tuple[int, int, List[Tuple[str, torch.Tensor]]]] = {}
+_feedback_lock = threading.Lock()
+_feedback_serial = 0
+
+
+def store_feedback_frame(directory_path: str, frame: int, files: List[Tuple[str, torch.Tensor]]):
+    # the last frame saved to a directory, (file path, tensor) per batch entry, kept in memory for the loader
+    global _feedback_serial
+    with _feedback_lock:
+        _feedback_serial += 1
+        _feedback_frames[os.path.abspath(directory_path)] = (frame, _feedback_serial, files)
+
+
+def get_feedback_frame(directory_path: str, frame: int):
+    # (serial number, files) - the serial number changes whenever a frame is stored
+    with _feedback_lock:
+        (stored_frame, serial, files) = _feedback_frames.get(os.path.abspath(directory_path), (None, None, None))
+    if stored_frame != frame:
+        return None
+    return (serial, files)
+
+
 def pick_random_by_weight(data: List[Tuple[float, object]], rng: random.Random):
     total_weight = sum(map(lambda item: item[0], data))
     r = rng.random()
@@ -226,7 +334,8 @@ class DreamImage:
         else:
             self.pil_image.putpixel((x, y), (pixelvalue[0], pixelvalue[1], pixelvalue[2], 255))
 
-    def save_png(self, filepath, embed_info=False, prompt=None, extra_pnginfo=None):
+    def save_png(self, filepath, embed_info=False, prompt=None, extra_pnginfo=None, optimize=True,
+                 compress_level=6):
         info = PngInfo()
         print(filepath)
         if extra_pnginfo is not None:
@@ -235,16 +344,45 @@ class DreamImage:
         if prompt is not None:
             info.add_text("prompt", json.dumps(prompt))
         if embed_info:
-            self.pil_image.save(filepath, pnginfo=info, optimize=True)
+            self.pil_image.save(filepath, pnginfo=info, optimize=optimize, compress_level=compress_level)
         else:
-            self.pil_image.save(filepath, optimize=True)
+            self.pil_image.save(filepath, optimize=optimize, compress_level=compress_level)
 
     def save_jpg(self, filepath, quality=98):
         self.pil_image.save(filepath, quality=quality, optimize=True)
 
+    def save_webp(self, filepath, lossless=True, quality=80, method=4):
+        # for lossless images, quality is the compression effort
+        self.pil_image.save(filepath, format="WEBP", lossless=lossless, quality=quality, method=method)
+
+    def save_with_format(self, filepath, format_name, embed_info=False, prompt=None, extra_pnginfo=None):
+        # encoder settings per format from the encoding.formats configuration
+        options = dict(DreamConfig().get("encoding.formats." + format_name, {}))
+        if format_name.startswith("png"):
+            self.save_png(filepath, embed_info, prompt, extra_pnginfo, bool(options.get("optimize", True)),
+                          int(options.get("compress_level", 6)))
+        elif format_name.startswith("webp"):
+            self.save_webp(filepath, bool(options.get("lossless", True)), int(options.get("quality", 80)),
+                           int(options.get("method", 4)))
+        else:
+            self.save_jpg(filepath, int(DreamConfig().get("encoding.jpeg_quality", 95)))
+
     @classmethod
-    def from_file(cls, file_path):
-        return DreamImage(pil_image=Image.open(file_path))
+    def from_file(cls, file_path, target_size: Tuple[int, int] = None):
+        # with a target size, the image is decoded at a reduced resolution that is still at least that size
+        pil_image = Image.open(file_path)
+        if target_size:
+            (width, height) = (max(1, target_size[0]), max(1, target_size[1]))
+            if pil_image.format == "JPEG":
+                pil_image.draft(pil_image.mode, (width, height))
+            else:
+                factor = min(pil_image.width // width, pil_image.height // height)
+                if factor > 1:
+                    # reduce does not support palette and 16 bit images - converted as by the constructor
+                    if pil_image.mode not in ("RGB", "RGBA"):
+                        pil_image = pil_image.convert("RGB")
+                    pil_image = pil_image.reduce(factor)
+        return DreamImage(pil_image=pil_image)
 
 
 class DreamMask:
@@ -260,47 +398,173 @@ class DreamMask:
         return torch.from_numpy(numpy.array(self.pil_image).astype(numpy.float32) / 255.0)
 
 
-def list_images_in_directory(directory_path: str, pattern: str, alphabetic_index: bool) -> Dict[int, List[str]]:
-    if not os.path.isdir(directory_path):
-        return {}
-    dirs_to_search = [directory_path]
-    if os.path.isdir(os.path.join(directory_path, "batch_0001")):
-        dirs_to_search = list()
-        for i in range(10000):
-            dirpath = os.path.join(directory_path, "batch_" + (str(i).zfill(4)))
-            if not os.path.isdir(dirpath):
-                break
-            else:
-                dirs_to_search.append(dirpath)
+_IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.tiff', '.gif', '.bmp', '.webp')
 
-    def _num_from_filename(fn):
-        (text, _) = os.path.splitext(fn)
-        token = text.split("_")[-1]
-        if token.isdigit():
-            return int(token)
-        else:
+
+def _num_from_filename(fn):
+    (text, _) = os.path.splitext(fn)
+    token = text.split("_")[-1]
+    if token.isdigit():
+        return int(token)
+    else:
+        return -1
+
+
+def _match_names(names: List[str], pattern: str) -> List[str]:
+    # as glob - hidden files are only matched by patterns starting with a dot
+    if not pattern.startswith("."):
+        names = [name for name in names if not name.startswith(".")]
+    return fnmatch.filter(names, pattern)
+
+
+def _is_nested_pattern(pattern: str) -> bool:
+    return "/" in pattern or os.sep in pattern
+
+
+class _DirectoryListing:
+    def __init__(self, directory_path: str):
+        self.path = directory_path
+        self.names: List[str] = []
+        self.subdirs: List[str] = []
+        self.mtime = None
+        self._scanned_at = 0.0
+
+    def is_current(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self.mtime is None
+        # a directory changed within the mtime resolution of the file system could change again unnoticed
+        return mtime == self.mtime and self._scanned_at - mtime / 1e9 > 2.0
+
+    def scan(self):
+        self.names = []
+        self.subdirs = []
+        self.mtime = None
+        self._scanned_at = time.time()
+        try:
+            self.mtime = os.stat(self.path).st_mtime_ns
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    self.names.append(entry.name)
+                    if entry.is_dir():
+                        self.subdirs.append(entry.name)
+        except OSError:
+            self.mtime = None
+
+
+class DirectoryIndex:
+    # a cached listing of a directory and its batch_NNNN directories, rescanned when the directories are modified
+    def __init__(self, directory_path: str):
+        self._path = os.path.abspath(directory_path)
+        self._lock = threading.Lock()
+        self._listings: Dict[str, _DirectoryListing] = {}
+
+    def _listing(self, path) -> _DirectoryListing:
+        listing = self._listings.get(path, None)
+        if listing is None:
+            listing = _DirectoryListing(path)
+            self._listings[path] = listing
+            listing.scan()
+        elif not listing.is_current():
+            listing.scan()
+        return listing
+
+    def _search_paths(self) -> List[str]:
+        top = self._listing(self._path)
+        if "batch_0001" not in top.subdirs:
+            return [self._path]
+        search_paths = list()
+        subdirs = set(top.subdirs)
+        for i in range(len(subdirs)):
+            name = "batch_" + (str(i).zfill(4))
+            if name not in subdirs:
+                break
+            search_paths.append(os.path.join(self._path, name))
+        return search_paths
+
+    def invalidate(self):
+        with self._lock:
+            self._listings = {}
+
+    def exists(self):
+        return os.path.isdir(self._path)
+
+    def _matching(self, path, pattern: str) -> List[str]:
+        if _is_nested_pattern(pattern):
+            # patterns reaching into subdirectories are not covered by the cached listing
+            return glob.glob(pattern, root_dir=path)
+        return _match_names(self._listing(path).names, pattern)
+
+    def files(self, pattern: str) -> List[str]:
+        with self._lock:
+            return [os.path.join(self._path, name) for name in self._matching(self._path, pattern)]
+
+    def count(self, patterns: str) -> int:
+        with self._lock:
+            return sum(map(lambda pattern: len(self._matching(self._path, pattern)), patterns.split("|")))
+
+    def images(self, pattern: str, alphabetic_index: bool) -> Dict[int, List[str]]:
+        with self._lock:
+            if not self.exists():
+                return {}
+            result = dict()
+            for search_path in self._search_paths():
+                files = []
+                for file_name in self._matching(search_path, pattern):
+                    if file_name.lower().endswith(_IMAGE_EXTENSIONS):
+                        files.append(os.path.join(search_path, file_name))
+
+                if alphabetic_index:
+                    files.sort()
+                    for idx, item in enumerate(files):
+                        lst = result.get(idx, [])
+                        lst.append(item)
+                        result[idx] = lst
+                else:
+                    for filepath in files:
+                        idx = _num_from_filename(os.path.basename(filepath))
+                        lst = result.get(idx, [])
+                        lst.append(filepath)
+                        result[idx] = lst
+            return result
+
+    def max_index(self, pattern: str, alphabetic_index: bool) -> int:
+        images = self.images(pattern, alphabetic_index)
+        if not images:
             return -1
+        return max(images.keys())
 
-    result = dict()
-    for search_path in dirs_to_search:
-        files = []
-        for file_name in glob.glob(os.path.join(search_path, pattern), recursive=False):
-            if file_name.lower().endswith(('.jpeg', '.jpg', '.png', '.tiff', '.gif', '.bmp', '.webp')):
-                files.append(os.path.abspath(file_name))
-
-        if alphabetic_index:
-            files.sort()
-            for idx, item in enumerate(files):
-                lst = result.get(idx, [])
-                lst.append(item)
-                result[idx] = lst
-        else:
-            for filepath in files:
-                idx = _num_from_filename(os.path.basename(filepath))
-                lst = result.get(idx, [])
-                lst.append(filepath)
-                result[idx] = lst
-    return result
+
+_directory_indexes: Dict[str, DirectoryIndex] = {}
+_directory_indexes_lock = threading.Lock()
+
+
+def directory_index(directory_path: str) -> DirectoryIndex:
+    # write errors are left for the saver to raise
+    flush_pending_writes(False)
+    key = os.path.abspath(directory_path)
+    with _directory_indexes_lock:
+        index = _directory_indexes.get(key, None)
+        if index is None:
+            index = DirectoryIndex(key)
+            _directory_indexes[key] = index
+        return index
+
+
+def invalidate_directory_index(directory_path: str):
+    key = os.path.abspath(directory_path)
+    with _directory_indexes_lock:
+        indexes = [index for (path, index) in _directory_indexes.items()
+                   if path == key or key.startswith(path + os.sep)]
+    for index in indexes:
+        index.invalidate()
+
+
+def list_images_in_directory(directory_path: str, pattern: str, alphabetic_index: bool) -> Dict[int, List[str]]:
+    if not directory_path or not os.path.isdir(directory_path):
+        return {}
+    return directory_index(directory_path).images(pattern, alphabetic_index)
 
 
 class DreamStateStore:
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import bisect
+import json
+import os
+import subprocess
+import threading
+from fractions import Fraction
+from typing import List
+
+import numpy
+
+from .shared import DreamConfig, TEMP_PATH, get_logger, hashed_as_strings
+
+
+def _ffprobe_path(config: DreamConfig):
+    path = config.get("video_source.ffprobe_path", "")
+    if path:
+        return path
+    (directory, name) = os.path.split(config.get("ffmpeg.path", "ffmpeg"))
+    return os.path.join(directory, name.replace("ffmpeg", "ffprobe"))
+
+
+def _ffprobe(config: DreamConfig, video_path, entries):
+    cmd = [_ffprobe_path(config), "-v", "error", "-select_streams", "v:0", "-show_entries", entries, "-of", "json",
+           video_path]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise Exception("ffprobe not found - set video_source.ffprobe_path in config.json")
+    if result.returncode != 0:
+        raise Exception("ffprobe failed on '{}' ({})".format(video_path, result.stderr.decode(errors="replace").strip()))
+    return json.loads(result.stdout.decode(errors="replace"))
+
+
+class VideoSeekIndex:
+    # presentation time of every frame of the first video stream and the frames that are keyframes, built once
+    # per file with ffprobe and cached in the temp directory - times are relative to the first video frame, which
+    # starts 'start_offset' seconds after the start of the file (e.g. when the audio starts earlier)
+    VERSION = 2
+
+    def __init__(self, width: int, height: int, fps: float, pts: List[float], keyframes: List[int],
+                 start_offset: float = 0.0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.pts = pts
+        self.keyframes = keyframes
+        self.start_offset = start_offset
+
+    def __len__(self):
+        return len(self.pts)
+
+    @classmethod
+    def _cache_path(cls, video_path):
+        stat = os.stat(video_path)
+        key = hashed_as_strings(os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns, cls.VERSION)
+        return os.path.join(TEMP_PATH, "video_index", key + ".json")
+
+    @classmethod
+    def for_file(cls, video_path, config: DreamConfig):
+        cache_path = cls._cache_path(video_path)
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, encoding="utf-8") as f:
+                    data = json.load(f)
+                return VideoSeekIndex(data["width"], data["height"], data["fps"], data["pts"], data["keyframes"],
+                                      data["start_offset"])
+            except (ValueError, KeyError):
+                pass
+        index = cls.build(video_path, config)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"width": index.width, "height": index.height, "fps": index.fps, "pts": index.pts,
+                       "keyframes": index.keyframes, "start_offset": index.start_offset}, f)
+        os.replace(tmp_path, cache_path)
+        return index
+
+    @classmethod
+    def build(cls, video_path, config: DreamConfig):
+        streams = _ffprobe(config, video_path, "stream=width,height,avg_frame_rate,r_frame_rate").get("streams", [])
+        if not streams:
+            raise Exception("No video stream in '{}'".format(video_path))
+        stream = streams[0]
+        fps = 0.0
+        for rate in (stream.get("avg_frame_rate", ""), stream.get("r_frame_rate", "")):
+            try:
+                fps = float(Fraction(rate))
+            except (ValueError, ZeroDivisionError):
+                continue
+            if fps > 0:
+                break
+        # packets are listed in decoding order and only need to be read, not decoded
+        frames = list()
+        for packet in _ffprobe(config, video_path, "packet=pts_time,dts_time,flags").get("packets", []):
+            time = packet.get("pts_time", packet.get("dts_time", None))
+            try:
+                frames.append((float(time), "K" in packet.get("flags", "")))
+            except (TypeError, ValueError):
+                continue
+        if not frames:
+            raise Exception("No video frames in '{}'".format(video_path))
+        frames.sort()
+        start = frames[0][0]
+        pts = [round(time - start, 6) for (time, _) in frames]
+        keyframes = [n for (n, (_, key)) in enumerate(frames) if key] or [0]
+        # ffmpeg seeks relative to the start of the file, the earliest start of all streams
+        try:
+            file_start = float(_ffprobe(config, video_path, "format=start_time").get("format", {})["start_time"])
+        except (KeyError, TypeError, ValueError):
+            file_start = start
+        get_logger().info("Indexed '{}': {} frames, {} keyframes", video_path, len(pts), len(keyframes))
+        return VideoSeekIndex(int(stream["width"]), int(stream["height"]), fps or 25.0, pts, keyframes,
+                              round(start - file_start, 6))
+
+    def keyframe_before(self, frame: int) -> int:
+        return self.keyframes[max(0, bisect.bisect_right(self.keyframes, frame) - 1)]
+
+    def frame_at_time(self, seconds: float) -> int:
+        return max(0, bisect.bisect_right(self.pts, seconds + 1e-6) - 1)
+
+
+class VideoFrameReader:
+    # decodes frames through an ffmpeg pipe that is kept open, so that consecutive frames are read sequentially -
+    # other frames start a new pipe at the closest keyframe before the frame
+    def __init__(self, video_path, config: DreamConfig):
+        self._path = video_path
+        self._config = config
+        self.index = VideoSeekIndex.for_file(video_path, config)
+        self._frame_bytes = self.index.width * self.index.height * 3
+        self._lock = threading.Lock()
+        self._proc = None
+        self._next = 0
+        self._last = (None, None)
+
+    def _start(self, frame: int):
+        self._stop()
+        keyframe = self.index.keyframe_before(frame)
+        # half a frame early, so that rounding of the timestamps cannot skip the keyframe
+        start = max(0.0, self.index.start_offset + self.index.pts[keyframe] - 0.5 / self.index.fps)
+        cmd = [self._config.get("ffmpeg.path", "ffmpeg")]
+        cmd.extend(self._config.get("video_source.decode_arguments"))
+        cmd = list(map(lambda s: s.replace("%START%", "{:.6f}".format(start)).replace("%INPUT%", self._path), cmd))
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL)
+        self._next = keyframe
+
+    def _stop(self):
+        if self._proc is not None:
+            proc = self._proc
+            self._proc = None
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+
+    def frame(self, frame: int) -> numpy.ndarray:
+        if frame < 0 or frame >= len(self.index):
+            raise Exception("Frame {} is outside of '{}' ({} frames)".format(frame, self._path, len(self.index)))
+        with self._lock:
+            if self._last[0] == frame:
+                return self._last[1]
+            if self._proc is None or frame < self._next or self.index.keyframe_before(frame) > self._next:
+                self._start(frame)
+            data = None
+            while self._next <= frame:
+                data = self._proc.stdout.read(self._frame_bytes)
+                if len(data) < self._frame_bytes:
+                    self._stop()
+                    raise Exception("Could not decode frame {} of '{}'".format(self._next, self._path))
+                self._next += 1
+            image = numpy.frombuffer(data, dtype=numpy.uint8).reshape((self.index.height, self.index.width, 3))
+            self._last = (frame, image)
+            return image
+
+    def close(self):
+        with self._lock:
+            self._stop()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+import abc
+import os
+import queue
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List
+
+import imageio
+import numpy
+from PIL import Image
+
+from .shared import DreamConfig, get_logger
+
+
+def ffmpeg_command(config: DreamConfig, arguments_key: str, replacements: Dict[str, str]) -> List[str]:
+    cmd = [config.get("ffmpeg.path", "ffmpeg")]
+    if config.get("ffmpeg.progress", True):
+        cmd.extend(["-progress", "pipe:1", "-nostats"])
+    cmd.extend(config.get(arguments_key))
+    for (key, value) in replacements.items():
+        cmd = list(map(lambda s: s.replace(key, value), cmd))
+    return cmd
+
+
+def find_free_filename(filename, defaultdir, reserved=()):
+    if os.path.basename(filename) == filename:
+        filename = os.path.join(defaultdir, filename)
+    n = 1
+    tested = filename
+    while os.path.exists(tested) or tested in reserved:
+        n += 1
+        (b, ext) = os.path.splitext(filename)
+        tested = b + "_" + str(n) + ext
+    return tested
+
+
+def _decode_rgb(filename) -> numpy.ndarray:
+    with Image.open(filename) as pil_image:
+        return numpy.asarray(pil_image.convert("RGB"))
+
+
+def decoded_frames(filenames: Iterable[str], queue_size: int):
+    # decodes frames in a background thread, at most queue_size frames ahead of the consumer
+    frames = queue.Queue(maxsize=max(1, queue_size))
+    stopped = threading.Event()
+
+    def _put(item):
+        while not stopped.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _produce():
+        try:
+            for filename in filenames:
+                if stopped.is_set():
+                    return
+                _put(_decode_rgb(filename))
+            _put(None)
+        except BaseException as e:
+            _put(e)
+
+    thread = threading.Thread(target=_produce, name="dream_frame_decoder", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class FFmpegProgress:
+    def __init__(self, name: str, total_frames: int = 0, interval: float = 5.0):
+        self._name = name
+        self._total_frames = total_frames
+        self._interval = interval
+        self._logger = get_logger()
+        self._started = time.time()
+        self._last_report = self._started
+        self._finished = None
+        self.frames = 0
+
+    @property
+    def elapsed(self):
+        return (self._finished or time.time()) - self._started
+
+    @property
+    def frames_per_second(self):
+        return self.frames / max(0.001, self.elapsed)
+
+    @property
+    def eta(self):
+        if not self._total_frames or not self.frames:
+            return None
+        return max(0, self._total_frames - self.frames) / self.frames_per_second
+
+    def update(self, frames: int):
+        self.frames = frames
+        now = time.time()
+        if now - self._last_report >= self._interval:
+            self._last_report = now
+            eta = self.eta
+            self._logger.info("Encoding {}: {} frames, {:.1f} fps, {:.1f} s elapsed, ETA {}", self._name,
+                              self.frames, self.frames_per_second, self.elapsed,
+                              "-" if eta is None else "{:.1f} s".format(eta))
+
+    def read(self, stream):
+        # machine readable output from 'ffmpeg -progress'
+        for line in stream:
+            (key, _, value) = line.decode(errors="replace").strip().partition("=")
+            if key == "frame" and value.isdigit():
+                self.update(int(value))
+
+    def finish(self):
+        self._finished = time.time()
+        self._logger.info("Encoded {}: {}", self._name, self.summary())
+
+    def summary(self):
+        return "{} frames in {:.1f} s, {:.1f} fps".format(self.frames, self.elapsed, self.frames_per_second)
+
+
+class _FFmpegProcess:
+    def __init__(self, cmd: List[str], progress: FFmpegProgress, stdin=subprocess.DEVNULL):
+        # ffmpeg reads interactive commands from an inherited stdin and may change the terminal mode
+        self._progress = progress
+        self._stderr_tail = deque(maxlen=20)
+        self.proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._threads = [threading.Thread(target=self._read_stderr, name="dream_ffmpeg_stderr", daemon=True),
+                         threading.Thread(target=progress.read, args=(self.proc.stdout,),
+                                          name="dream_ffmpeg_progress", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def _read_stderr(self):
+        for line in self.proc.stderr:
+            self._stderr_tail.append(line.decode(errors="replace").rstrip())
+
+    def failure(self, message):
+        return Exception("{} ({})".format(message, " | ".join(self._stderr_tail)))
+
+    def wait(self):
+        code = self.proc.wait()
+        for thread in self._threads:
+            thread.join()
+        if code != 0:
+            raise self.failure("ffmpeg exited with code {}".format(code))
+
+
+def run_ffmpeg(cmd: List[str], progress: FFmpegProgress, total_frames: int):
+    _FFmpegProcess(cmd, progress).wait()
+    if not progress.frames:
+        # ffmpeg progress reporting disabled
+        progress.frames = total_frames
+    progress.finish()
+
+
+class VideoWriter(abc.ABC):
+    def __init__(self, config: DreamConfig, output: str, fps: float, total_frames: int = 0):
+        self._config = config
+        self._output = output
+        self._fps = float(fps)
+        self.progress = FFmpegProgress(os.path.basename(output), total_frames,
+                                       float(config.get("ffmpeg.progress_interval", 5.0)))
+        self.frames_written = 0
+
+    @property
+    def output(self):
+        return self._output
+
+    @abc.abstractmethod
+    def write(self, frame: numpy.ndarray):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class FFmpegPipeWriter(VideoWriter):
+    def __init__(self, config: DreamConfig, output: str, fps: float, arguments_key: str = "ffmpeg.pipe_arguments",
+                 total_frames: int = 0):
+        super().__init__(config, output, fps, total_frames)
+        self._arguments_key = arguments_key
+        self._ffmpeg = None
+        self._size = None
+        self._reports_progress = bool(config.get("ffmpeg.progress", True))
+
+    def _start(self, width, height):
+        cmd = ffmpeg_command(self._config, self._arguments_key,
+                             {"%FPS%": str(self._fps), "%WIDTH%": str(width), "%HEIGHT%": str(height),
+                              "%OUTPUT%": self._output})
+        self._ffmpeg = _FFmpegProcess(cmd, self.progress, subprocess.PIPE)
+        self._size = (width, height)
+
+    def write(self, frame: numpy.ndarray):
+        height, width = frame.shape[:2]
+        if self._ffmpeg is None:
+            self._start(width, height)
+        elif (width, height) != self._size:
+            raise Exception("Frame size {}x{} differs from video size {}x{}".format(width, height, *self._size))
+        try:
+            self._ffmpeg.proc.stdin.write(numpy.ascontiguousarray(frame, dtype=numpy.uint8).data)
+        except BrokenPipeError:
+            ffmpeg = self._ffmpeg
+            self.close()
+            raise ffmpeg.failure("ffmpeg stopped accepting frames")
+        self.frames_written += 1
+        if not self._reports_progress:
+            self.progress.update(self.frames_written)
+
+    def close(self):
+        if self._ffmpeg is None:
+            return
+        ffmpeg = self._ffmpeg
+        self._ffmpeg = None
+        try:
+            ffmpeg.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        ffmpeg.wait()
+        self.progress.update(max(self.progress.frames, self.frames_written))
+        self.progress.finish()
+
+
+class ImageioWriter(VideoWriter):
+    def __init__(self, config: DreamConfig, output: str, fps: float, total_frames: int = 0, incremental=False):
+        super().__init__(config, output, fps, total_frames)
+        self._writer = None
+        self._output_params = list(config.get("imageio.output_params", []))
+        if incremental:
+            # the same fragmented mp4 as the ffmpeg backend, so that an aborted render is still playable
+            self._output_params.extend(config.get("imageio.incremental_output_params", []))
+
+    def write(self, frame: numpy.ndarray):
+        if self._writer is None:
+            self._writer = imageio.get_writer(self._output, format="FFMPEG", mode="I", fps=self._fps,
+                                              codec=self._config.get("imageio.codec", "libx264"),
+                                              quality=self._config.get("imageio.quality", 8),
+                                              pixelformat=self._config.get("imageio.pixelformat", "yuv420p"),
+                                              macro_block_size=int(self._config.get("imageio.macro_block_size", 2)),
+                                              output_params=self._output_params)
+        self._writer.append_data(frame)
+        self.frames_written += 1
+        self.progress.update(self.frames_written)
+
+    def close(self):
+        if self._writer is None:
+            return
+        writer = self._writer
+        self._writer = None
+        writer.close()
+        self.progress.finish()
+
+
+def create_video_writer(config: DreamConfig, output: str, fps: float, total_frames: int = 0,
+                        incremental=False) -> VideoWriter:
+    if config.get("encoding.video_backend", "ffmpeg") == "imageio":
+        return ImageioWriter(config, output, fps, total_frames, incremental)
+    return FFmpegPipeWriter(config, output, fps,
+                            "ffmpeg.incremental_arguments" if incremental else "ffmpeg.pipe_arguments", total_frames)